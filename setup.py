@@ -15,7 +15,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
     ],
-    python_requires='>=3.6',  # Python 版本要求
+    python_requires='>=3.8',  # Python 版本要求，3.8 起 subprocess 支持 posix_spawn
     install_requires=[
         'ffmpeg-python',  # 依赖包
         # 在这里添加其他依赖
@@ -7,11 +7,14 @@
 import os
 import sys
 import json
+import copy
 import logging
+import shutil
 import subprocess
 import time  # 导入 time 模块
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import configparser
 import argparse  # 导入 argparse 模块
 import math  # 导入 math 模块
@@ -30,7 +33,52 @@ DEFAULT_SUPPORTED_FORMATS = (
 )
 
 CONFIG_FILE = "config.ini"
-CHUNK_SIZE_MB = 100  # 每个切割文件的大小（MB）
+CHUNK_SIZE_MB = 100  # 超过该大小（MB）的文件才切割
+MIN_CHUNK_MB = 25  # 每个切割区间的最小大小（MB），避免区间过多时启动开销占主导
+MAX_HW_ENCODER_SESSIONS = 3  # 硬件编码器同时编码的区间数上限（消费级显卡的 NVENC 会话数有限）
+PROBE_CACHE_FILE = ".transcode_cache.json"  # ffprobe 结果缓存文件，保存在输入目录下
+COPY_SUFFIXES = frozenset(('.mp4', '.m4v', '.mov'))  # 已是 H.264/AAC 时可直接复制流的容器
+
+# 可选的 H.264 编码器：name 为 ffmpeg 中的编码器名，input_args 放在 -i 之前，args 为视频编码参数
+VIDEO_ENCODERS = {
+    'x264': {'name': 'libx264', 'args': ['-c:v', 'libx264', '-preset', 'medium', '-crf', '23']},
+    'videotoolbox': {'name': 'h264_videotoolbox', 'args': ['-c:v', 'h264_videotoolbox', '-b:v', '4M']},
+    'nvenc': {'name': 'h264_nvenc', 'args': ['-c:v', 'h264_nvenc', '-preset', 'p5', '-cq', '23']},
+    'qsv': {'name': 'h264_qsv', 'args': ['-c:v', 'h264_qsv', '-global_quality', '23']},
+    'vaapi': {
+        'name': 'h264_vaapi',
+        'input_args': ['-vaapi_device', '/dev/dri/renderD128'],
+        'args': ['-vf', 'format=nv12,hwupload', '-c:v', 'h264_vaapi', '-qp', '23'],
+    },
+}
+HW_ENCODER_PRIORITY = ('videotoolbox', 'nvenc', 'qsv', 'vaapi')  # auto 模式下的检测顺序
+
+# 启动时解析一次 ffmpeg/ffprobe 的绝对路径：省去每次启动子进程时的 PATH 查找，
+# 也是 subprocess 使用 posix_spawn 的前提条件之一
+EXECUTABLES = {name: shutil.which(name) or name for name in ('ffmpeg', 'ffprobe')}
+
+def _resolve_command(cmd: List[str]) -> List[str]:
+    """把命令中的 ffmpeg/ffprobe 替换为绝对路径"""
+    return [EXECUTABLES.get(cmd[0], cmd[0])] + cmd[1:]
+
+def _default_stdin(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """未指定输入时 stdin 指向 /dev/null：多个 ffmpeg 并行运行时不再争抢终端按键、改动终端设置"""
+    # input=None 与未传 input 相同，同样需要指定 stdin
+    if kwargs.get('input') is None and 'stdin' not in kwargs:
+        kwargs['stdin'] = subprocess.DEVNULL
+    return kwargs
+
+def run_command(cmd: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """执行外部命令
+
+    close_fds=False 时 subprocess 可以用 posix_spawn（或 vfork）代替 fork+exec，
+    不必复制父进程的页表；Python 创建的文件描述符默认不可继承（PEP 446），不会泄露给子进程。
+    """
+    return subprocess.run(_resolve_command(cmd), close_fds=False, **_default_stdin(kwargs))
+
+def popen_command(cmd: List[str], **kwargs) -> subprocess.Popen:
+    """以 Popen 启动外部命令，启动方式同 run_command"""
+    return subprocess.Popen(_resolve_command(cmd), close_fds=False, **_default_stdin(kwargs))
 
 def create_config_file():
     """创建 config.ini 文件并写入默认支持的视频格式"""
@@ -52,199 +100,533 @@ def load_supported_formats(config_file: str) -> List[str]:
             return [fmt.strip() for fmt in formats.split(',')]
     return list(DEFAULT_SUPPORTED_FORMATS)
 
+# 导入时读取一次配置，不必每次运行都重新解析；统一小写由 VideoTranscoder 负责
+SUPPORTED_SUFFIXES = tuple(load_supported_formats(CONFIG_FILE))
+
+def default_jobs() -> int:
+    """默认并行转码的文件数：CPU 核数的一半"""
+    return max(1, (os.cpu_count() or 1) // 2)
+
+def available_encoders() -> List[str]:
+    """通过 ffmpeg -encoders 列出当前 ffmpeg 支持的 VIDEO_ENCODERS 中的编码器"""
+    try:
+        result = run_command(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        logger.error(f"Error listing ffmpeg encoders: {e}")
+        return []
+    names = set(result.stdout.split())
+    return [key for key, encoder in VIDEO_ENCODERS.items() if encoder['name'] in names]
+
+def encoder_works(key: str) -> bool:
+    """用一帧纯色画面试编码：ffmpeg 编译了硬件编码器不代表本机有对应的设备和驱动"""
+    encoder = VIDEO_ENCODERS[key]
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error'] + encoder.get('input_args', []) + [
+        '-f', 'lavfi', '-i', 'color=s=256x256',  # 部分硬件编码器不支持过小的分辨率
+        '-frames:v', '1'
+    ] + encoder['args'] + ['-f', 'null', '-']
+    try:
+        run_command(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=30)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
+        logger.info(f"Encoder {encoder['name']} failed a test encode")
+        return False
+    return True
+
+def detect_encoder(available: List[str]) -> Optional[str]:
+    """按 HW_ENCODER_PRIORITY 选择第一个能试编码成功的硬件编码器，都不可用时回退到 libx264"""
+    for key in HW_ENCODER_PRIORITY + ('x264',):
+        if key in available and encoder_works(key):
+            return key
+    return None
+
 class VideoTranscoder:
-    def __init__(self, directory: str, search_mode: str, supported_formats: List[str], ffmpeg_logging: bool):
+    def __init__(self, directory: str, search_mode: str, supported_formats: List[str], ffmpeg_logging: bool,
+                 jobs: int = 1, encoder: str = 'x264', two_pass: bool = False, bitrate: str = '2M',
+                 batch_size: int = 1):
         self.directory = Path(directory)
         self.search_mode = search_mode
-        self.supported_formats = supported_formats
+        # 小写后缀元组供 str.endswith 使用，在 C 层完成匹配；空字符串（如配置末尾多余的逗号）会匹配所有文件，需要去掉
+        self.supported_formats = tuple(fmt.lower() for fmt in supported_formats if fmt)
         self.ffmpeg_logging = ffmpeg_logging  # 控制 ffmpeg 日志输出
+        self.jobs = max(1, jobs)  # 同时转码的文件数
+        self.threads = max(1, (os.cpu_count() or 1) // self.jobs)  # 每个 ffmpeg 使用的线程数
+        self.encoder = encoder  # VIDEO_ENCODERS 中的键
+        self.two_pass = two_pass  # 使用 libx264 两遍编码代替 CRF
+        self.bitrate = bitrate  # 两遍编码的目标视频码率
+        self.batch_size = max(1, batch_size)  # 每个 ffmpeg 进程同时转码的小文件数
+        self.hw_sessions = MAX_HW_ENCODER_SESSIONS  # 单个文件可同时占用的硬件编码会话数
+        self.probe_cache_file = self.directory / PROBE_CACHE_FILE
+        self.probe_cache = self.load_probe_cache()  # key: 路径:mtime_ns:大小 -> ffprobe 结果
+        self.saved_probe_keys = set(self.probe_cache)  # 缓存文件中已有的条目，未变化时无需重写
+        self.new_probe_entries: Dict[str, Any] = {}  # 本进程新增的缓存条目，由工作进程带回主进程
+
+    def load_probe_cache(self) -> Dict[str, Any]:
+        """读取 ffprobe 缓存，文件不存在或损坏时返回空缓存"""
+        try:
+            with open(self.probe_cache_file) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def save_probe_cache(self) -> None:
+        """写回 ffprobe 缓存，丢弃源文件已不存在的条目；缓存为空时删除缓存文件，未变化时不写"""
+        cache = {key: info for key, info in self.probe_cache.items() if os.path.exists(key.rsplit(':', 2)[0])}
+        try:
+            if not cache:
+                # 源文件全部转码完成后缓存不再有用，不在输出目录留下空的缓存文件
+                if self.probe_cache_file.exists():
+                    self.probe_cache_file.unlink()
+            elif cache.keys() != self.saved_probe_keys:
+                with open(self.probe_cache_file, 'w') as f:
+                    json.dump(cache, f)
+                self.saved_probe_keys = set(cache)
+        except OSError as e:
+            logger.error(f"Error writing probe cache {self.probe_cache_file}: {e}")
+
+    def for_batch(self, input_paths: List[Path]) -> 'VideoTranscoder':
+        """交给工作进程的副本：只带本批文件的缓存条目，提交任务时不必序列化整个缓存"""
+        worker = copy.copy(self)
+        worker.probe_cache = {}
+        for input_path in input_paths:
+            try:
+                key = self.probe_cache_key(input_path)
+            except OSError:
+                continue  # 文件已不存在，由工作进程报告失败
+            if key in self.probe_cache:
+                worker.probe_cache[key] = self.probe_cache[key]
+        worker.saved_probe_keys = set()
+        worker.new_probe_entries = {}
+        return worker
+
+    @staticmethod
+    def probe_cache_key(file_path: Path) -> str:
+        """以路径、修改时间和大小作为缓存键，文件变化后自动失效"""
+        stat = file_path.stat()
+        return f"{file_path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def _input_args(self) -> List[str]:
+        """放在 -i 之前的编码器参数（如 VAAPI 设备）"""
+        return VIDEO_ENCODERS[self.encoder].get('input_args', [])
+
+    def _two_pass_video_args(self, pass_num: int, passlogfile: Path) -> List[str]:
+        """libx264 两遍编码的视频参数，以目标码率代替 CRF"""
+        return [
+            '-c:v', 'libx264', '-preset', 'medium', '-b:v', self.bitrate,
+            '-pass', str(pass_num), '-passlogfile', str(passlogfile),
+        ]
+
+    def _encode_args(self, threads: Optional[int] = None, passlogfile: Optional[Path] = None) -> List[str]:
+        """H.264/AAC 编码参数，threads 默认使用 self.threads；给出 passlogfile 时为两遍编码的第二遍"""
+        if passlogfile:
+            args = self._two_pass_video_args(2, passlogfile)
+        else:
+            args = list(VIDEO_ENCODERS[self.encoder]['args'])
+        if self.encoder == 'x264':
+            args += ['-threads', str(threads or self.threads)]  # 硬件编码器不占用 CPU 线程
+        return args + [
+            '-c:a', 'aac', '-strict', '2', '-b:a', '128k',
+            '-movflags', '+faststart',
+        ]
+
+    @staticmethod
+    def output_path_for(input_path: Path) -> Path:
+        """转码结果的文件名：原始文件名去掉后缀，加上 ..mp4"""
+        return input_path.with_name(f"{input_path.stem}..mp4")
+
+    @staticmethod
+    def chunk_path_for(input_path: Path, index: int) -> Path:
+        """第 index 个切割区间的转码结果文件名"""
+        return input_path.with_name(f"{input_path.stem}_part{index}..mp4")
+
+    @staticmethod
+    def _temp_path(output_path: Path) -> Path:
+        """ffmpeg 先写入同目录下的 .tmp 文件，成功后再改名，中断时不会留下不完整的 ..mp4 文件"""
+        return output_path.with_name(output_path.name + '.tmp')
+
+    def _output_args(self, output_path: Path) -> List[str]:
+        """写入临时文件的输出参数；临时文件后缀不是 .mp4，需要显式指定格式"""
+        return ['-f', 'mp4', '-y', str(self._temp_path(output_path))]
+
+    def _finish_output(self, output_path: Path) -> bool:
+        """检查临时文件非空后原子改名为正式输出文件"""
+        temp_path = self._temp_path(output_path)
+        if temp_path.exists() and temp_path.stat().st_size > 0:
+            temp_path.replace(output_path)
+            return True
+        logger.error(f"Output file is empty or not created: {output_path}")
+        self._remove_temp_output(output_path)
+        return False
+
+    def _remove_temp_output(self, output_path: Path) -> None:
+        """删除未完成的临时输出文件；已改名为正式输出时不做任何事"""
+        temp_path = self._temp_path(output_path)
+        if temp_path.exists():
+            temp_path.unlink()
+
+    def _first_pass(self, input_cmd: List[str], passlogfile: Path, threads: Optional[int] = None) -> None:
+        """两遍编码的第一遍：只分析视频并写入统计文件，不输出音视频"""
+        cmd = input_cmd + self._two_pass_video_args(1, passlogfile) + [
+            '-threads', str(threads or self.threads), '-an', '-f', 'null', '-y', os.devnull
+        ]
+        self._run_ffmpeg(cmd)
+
+    @staticmethod
+    def _remove_pass_logs(passlogfile: Path) -> None:
+        """删除 libx264 两遍编码产生的统计文件"""
+        for suffix in ('-0.log', '-0.log.mbtree'):
+            log_file = passlogfile.with_name(passlogfile.name + suffix)
+            if log_file.exists():
+                log_file.unlink()
+
+    def _run_ffmpeg(self, cmd: List[str], input: Optional[str] = None) -> None:
+        """执行 ffmpeg 命令；开启日志时逐行转发 ffmpeg 输出，否则直接丢弃。input 非空时写入 ffmpeg 的 stdin"""
+        # 控制 ffmpeg 日志输出
+        if not self.ffmpeg_logging:
+            cmd = cmd + ['-loglevel', 'quiet']
+
+        # 输出 ffmpeg 命令到日志
+        self._log_command(cmd)
+
+        if self.ffmpeg_logging:
+            # 使用 Popen 执行命令并实时输出日志；ffmpeg 日志写在 stderr，合并到 stdout 逐行读取，避免管道写满阻塞
+            stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL
+            process = popen_command(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            if input is not None:
+                # 输入很短（concat 文件列表），先整体写入再读取输出，不会因管道写满而阻塞
+                process.stdin.write(input)
+                process.stdin.close()
+            for line in process.stdout:
+                logger.info(f"FFmpeg output: {line.strip()}")
+            if process.wait() != 0:  # 等待进程结束
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+        else:
+            # 不输出日志时直接丢弃 ffmpeg 输出，不经过 Python 逐行读取
+            run_command(cmd, input=input, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True, check=True)
+
+    def _log_command(self, cmd: List[str]) -> None:
+        """仅在开启 ffmpeg 日志时输出命令，关闭时省去拼接命令字符串"""
+        if self.ffmpeg_logging and logger.isEnabledFor(logging.INFO):
+            logger.info("Executing command: %s", ' '.join(cmd))
+
+    def get_video_info(self, file_path: Path, need_streams: bool = False) -> Optional[Dict[str, Any]]:
+        """获取视频文件信息，优先使用缓存；need_streams 为 True 时结果需包含各流的编码信息"""
+        key = self.probe_cache_key(file_path)
+        cached = self.probe_cache.get(key)
+        if cached and (not need_streams or 'streams' in cached):
+            return cached
 
-    def get_video_info(self, file_path: Path) -> Optional[Dict[str, Any]]:
-        """获取视频文件信息"""
         try:
+            # 只请求用到的字段，输出 [SECTION] 包裹的 key=value 行，省去 JSON 解析
             cmd = [
-                'ffprobe', '-v', 'quiet', 
-                '-print_format', 'json',
-                '-show_format', '-show_streams', 
+                'ffprobe', '-v', 'quiet',
+                '-show_entries', 'format=duration,size,format_name:stream=codec_type,codec_name',
+                '-of', 'default=nokey=0',
                 str(file_path)
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            return json.loads(result.stdout)
+            result = run_command(cmd, capture_output=True, text=True, check=True)
         except subprocess.CalledProcessError as e:
             logger.error(f"Error getting video info for {file_path}: {e}")
             return None
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing video info for {file_path}: {e}")
+
+        # 解析为与 ffprobe JSON 相同的结构：{'format': {...}, 'streams': [{...}, ...]}
+        info = {'format': {}, 'streams': []}
+        section = None
+        for line in result.stdout.splitlines():
+            if line == '[FORMAT]':
+                section = info['format']
+            elif line == '[STREAM]':
+                section = {}
+                info['streams'].append(section)
+            elif line.startswith('[/'):
+                section = None
+            elif section is not None and '=' in line:
+                name, value = line.split('=', 1)
+                section[name] = value
+        if 'duration' not in info['format']:
+            logger.error(f"Error parsing video info for {file_path}: no duration in ffprobe output")
             return None
 
-    def split_video(self, input_path: Path, duration: float, size_mb: float) -> List[Path]:
-        """将视频文件切割为多个小文件"""
+        self.probe_cache[key] = info
+        self.new_probe_entries[key] = info
+        return info
+
+    @staticmethod
+    def is_h264_aac(video_info: Dict[str, Any]) -> bool:
+        """视频流均为 H.264、音频流均为 AAC（允许没有音频）时返回 True"""
+        streams = video_info.get('streams', [])
+        video_codecs = [s.get('codec_name') for s in streams if s.get('codec_type') == 'video']
+        audio_codecs = [s.get('codec_name') for s in streams if s.get('codec_type') == 'audio']
+        return bool(video_codecs) and all(c == 'h264' for c in video_codecs) and all(c == 'aac' for c in audio_codecs)
+
+    @staticmethod
+    def has_video_stream(video_info: Dict[str, Any]) -> bool:
+        """是否包含视频流；纯音频文件（mp3、wav 等）返回 False"""
+        return any(s.get('codec_type') == 'video' for s in video_info.get('streams', []))
+
+    def chunk_slots(self) -> int:
+        """单个文件可同时编码的区间数：libx264 按分到的 CPU 线程数，硬件编码器按并发会话上限"""
+        return self.threads if self.encoder == 'x264' else self.hw_sessions
+
+    def split_video(self, input_path: Path, duration: float, size_mb: float) -> List[Tuple[float, Optional[float]]]:
+        """计算切割区间 (起始时间, 时长)，不生成中间文件；最后一个区间时长为 None，一直读到文件末尾"""
         logger.info(f"Splitting video {input_path.name} into chunks based on duration and size.")
-        
-        # 计算切分个数
-        num_chunks = math.ceil(size_mb / CHUNK_SIZE_MB)  # 向上取整
-        logger.info(f"Calculated number of chunks: {num_chunks}")
-
-        chunk_files = []
-        for i in range(num_chunks):
-            start_time = i * (duration / num_chunks)  # 每个切割文件的起始时间（秒）
-            chunk_file = input_path.with_name(f"{input_path.stem}_part{i + 1}.mp4")
-            cmd = [
-                'ffmpeg', '-i', str(input_path),
-                '-ss', str(start_time),  # 从指定位置开始切割
-                '-t', str(duration / num_chunks),  # 切割指定时长（秒）
-                '-c', 'copy',  # 直接复制，不重新编码
-                str(chunk_file)
-            ]
-            if not self.ffmpeg_logging:
-                cmd.append('-loglevel')
-                cmd.append('quiet')
-
-            logger.info(f"Executing split command: {' '.join(cmd)}")
-            subprocess.run(cmd, check=True)
-            chunk_files.append(chunk_file)
-            logger.info(f"Created chunk: {chunk_file.name}")
 
-        return chunk_files
-
-    def transcode_chunk(self, chunk_file: Path) -> Path:
-        """转码切割后的视频文件"""
-        output_path = chunk_file.with_name(f"{chunk_file.stem}..mp4")  # 输出文件名加上 "..mp4"
-        logger.info(f"Starting transcoding for chunk {chunk_file.name} to {output_path.name}")
-        cmd = [
-            'ffmpeg', '-i', str(chunk_file),
-            '-c:v', 'libx264', '-preset', 'medium',
-            '-crf', '23', '-c:a', 'aac',
-            '-strict', '2', '-b:a', '128k',
-            '-movflags', '+faststart', '-y', str(output_path)
-        ]
-        
-        # 控制 ffmpeg 日志输出
-        if not self.ffmpeg_logging:
-            cmd.append('-loglevel')
-            cmd.append('quiet')
-
-        logger.info(f"Executing command: {' '.join(cmd)}")
-        subprocess.run(cmd, check=True)
-        logger.info(f"Transcoding completed for chunk {chunk_file.name}")
+        # 计算切分个数：每段不小于 MIN_CHUNK_MB，且不超过本文件可并行编码的区间数
+        num_chunks = max(1, min(self.chunk_slots(), math.ceil(size_mb / MIN_CHUNK_MB)))
+        logger.info(f"Calculated number of chunks: {num_chunks}")
 
-        # 删除原始切割文件
-        chunk_file.unlink()  # 删除原始切割文件
-        logger.info(f"Deleted original chunk file: {chunk_file.name}")
+        chunk_duration = duration / num_chunks  # 每个切割区间的时长（秒）
+        # 容器时长可能与实际音视频流略有出入，最后一个区间不限时长，避免截掉结尾
+        return [(i * chunk_duration, chunk_duration if i < num_chunks - 1 else None) for i in range(num_chunks)]
+
+    def transcode_chunk(self, input_path: Path, index: int, start_time: float, chunk_duration: Optional[float],
+                        threads: Optional[int] = None, two_pass: bool = False) -> Path:
+        """直接从原始文件读取指定区间并转码，省去先切割再读回的中间文件"""
+        output_path = self.chunk_path_for(input_path, index)
+        logger.info(f"Starting transcoding for chunk {index} of {input_path.name} to {output_path.name}")
+        input_cmd = ['ffmpeg', '-ss', str(start_time)]  # 放在 -i 之前，按索引快速定位
+        if chunk_duration is not None:
+            input_cmd += ['-t', str(chunk_duration)]  # 只读取指定时长（秒）；最后一个区间读到文件末尾
+        input_cmd += self._input_args() + ['-i', str(input_path)]
+
+        # 两遍编码时每个区间使用各自的统计文件，区间之间仍可并行
+        passlogfile = input_path.with_name(f"{input_path.stem}_part{index}_2pass") if two_pass else None
+        try:
+            if passlogfile:
+                self._first_pass(input_cmd, passlogfile, threads)
+
+            cmd = input_cmd + self._encode_args(threads, passlogfile) + self._output_args(output_path)
+            self._run_ffmpeg(cmd)
+        finally:
+            if passlogfile:
+                self._remove_pass_logs(passlogfile)
+        if not self._finish_output(output_path):
+            raise RuntimeError(f"Chunk {index} of {input_path.name} produced no output")
+        logger.info(f"Transcoding completed for chunk {output_path.name}")
 
         return output_path
 
     def merge_videos(self, chunk_files: List[Path], original_file: Path) -> None:
         """合并切割后的视频文件"""
-        output_path = original_file.with_name(f"{original_file.stem}..mp4")  # 使用原始文件名，无后缀，加上 "..mp4"
+        output_path = self.output_path_for(original_file)
         logger.info(f"Merging {len(chunk_files)} chunks into {output_path.name}.")
-        with open("file_list.txt", "w") as f:
-            for chunk in chunk_files:
-                f.write(f"file '{chunk}'\n")
+        # 文件列表通过 stdin 传给 concat 分离器，不再写临时列表文件；路径中的单引号按 concat 语法转义
+        file_list = ''.join(
+            "file '{}'\n".format(str(chunk.resolve()).replace("'", "'\\''")) for chunk in chunk_files
+        )
 
-        cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', 'file_list.txt', '-c', 'copy', str(output_path)]
-        if not self.ffmpeg_logging:
-            cmd.append('-loglevel')
-            cmd.append('quiet')
-
-        logger.info(f"Executing merge command: {' '.join(cmd)}")
-        subprocess.run(cmd, check=True)
+        cmd = [
+            'ffmpeg', '-f', 'concat', '-safe', '0',
+            '-protocol_whitelist', 'file,pipe', '-i', 'pipe:0',
+            '-c', 'copy'
+        ] + self._output_args(output_path)
+        self._run_ffmpeg(cmd, input=file_list)
+        if not self._finish_output(output_path):
+            raise RuntimeError(f"Merging chunks of {original_file.name} produced no output")
         logger.info(f"Merged video created: {output_path.name}")
 
-        # 删除中间文件
-        for chunk in chunk_files:
-            chunk.unlink()  # 删除原始切割文件
-            logger.info(f"Deleted original chunk file: {chunk.name}")
-        os.remove("file_list.txt")  # 删除文件列表
-
-        # 删除原始文件
-        original_file.unlink()  # 删除最开始的原始文件
-        logger.info(f"Deleted original video file: {original_file.name}")
+    def _remove_chunk_files(self, input_path: Path, num_chunks: int) -> None:
+        """删除切割转码产生的中间文件"""
+        leftovers = [self._temp_path(self.output_path_for(input_path))]
+        for index in range(1, num_chunks + 1):
+            chunk_path = self.chunk_path_for(input_path, index)
+            leftovers += [chunk_path, self._temp_path(chunk_path)]
+        for path in leftovers:
+            if path.exists():
+                path.unlink()
+                logger.info(f"Deleted chunk file: {path.name}")
+
+    def remux_video(self, input_path: Path) -> bool:
+        """输入已是 H.264/AAC 时只复制音视频流到新的 MP4，并把索引移到文件头"""
+        output_path = self.output_path_for(input_path)
+        logger.info(f"{input_path.name} is already H.264/AAC, copying streams to {output_path.name}")
+        cmd = ['ffmpeg', '-i', str(input_path), '-c', 'copy', '-movflags', '+faststart'] + self._output_args(output_path)
+        try:
+            self._run_ffmpeg(cmd)
+        except BaseException:
+            self._remove_temp_output(output_path)  # ffmpeg 失败时不留下写了一半的临时文件
+            raise
+        return self._finish_output(output_path)
 
     def transcode_video(self, input_path: Path) -> bool:
         """转码视频文件为 MP4 格式"""
         try:
-            # 获取视频信息
-            video_info = self.get_video_info(input_path)
-            if video_info:
+            # 文件大小直接从文件系统获取，小文件无需调用 ffprobe
+            size_mb = input_path.stat().st_size / (1024 * 1024)  # 转换为 MB
+
+            # 已是 H.264/AAC 的 MP4/MOV 只需复制流，无需重新编码
+            video_info = None
+            if input_path.suffix.lower() in COPY_SUFFIXES:
+                video_info = self.get_video_info(input_path, need_streams=True)
+                if video_info and self.is_h264_aac(video_info):
+                    return self.remux_video(input_path)
+
+            # 两遍编码只针对视频流：纯音频输入的第一遍没有可输出的流，ffmpeg 会直接报错，改用单遍编码
+            two_pass = self.two_pass
+            if two_pass:
+                video_info = video_info or self.get_video_info(input_path, need_streams=True)
+                two_pass = not video_info or self.has_video_stream(video_info)
+
+            # 判断文件大小，决定是否切割；只能单路编码时切割没有收益
+            if size_mb > CHUNK_SIZE_MB and self.chunk_slots() > 1:
+                # 只有切割时才需要时长，此时再获取视频信息
+                video_info = video_info or self.get_video_info(input_path)
+                if not video_info:
+                    return False
+
                 # 提取并打印视频信息
                 duration = float(video_info['format']['duration'])
                 format_name = video_info['format']['format_name']
-                size_bytes = int(video_info['format']['size'])  # 文件大小（字节）
-                size_mb = size_bytes / (1024 * 1024)  # 转换为 MB
-                
+
                 logger.info(f"Video Info for {input_path.name}:")
                 logger.info(f"  Duration: {duration} seconds")
                 logger.info(f"  Format: {format_name}")
                 logger.info(f"  Size: {size_mb:.2f} MB")  # 输出为 MB，保留两位小数
 
-            # 判断文件大小，决定是否切割
-            if size_mb > CHUNK_SIZE_MB:
-                chunk_files = self.split_video(input_path, duration, size_mb)  # 切割视频
-                transcoded_chunks = [self.transcode_chunk(chunk) for chunk in chunk_files]  # 转换每个切割文件
-                self.merge_videos(transcoded_chunks, input_path)  # 合并切割后的视频
+                chunks = self.split_video(input_path, duration, size_mb)  # 计算切割区间
+                # 并行转码各区间，libx264 线程总数不超过本文件分到的 self.threads
+                workers = min(len(chunks), self.chunk_slots())
+                threads = max(1, self.threads // workers)
+                try:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        futures = [
+                            executor.submit(self.transcode_chunk, input_path, index, start_time, chunk_duration,
+                                            threads, two_pass)
+                            for index, (start_time, chunk_duration) in enumerate(chunks, start=1)
+                        ]
+                        try:
+                            # 按提交顺序取结果，合并时片段顺序不变
+                            transcoded_chunks = [future.result() for future in futures]
+                        except BaseException:
+                            # 任一区间失败时取消尚未开始的区间，退出 with 时只等待正在运行的区间
+                            for future in futures:
+                                future.cancel()
+                            raise
+                    self.merge_videos(transcoded_chunks, input_path)  # 合并切割后的视频
+                finally:
+                    # 无论成功与否都删除区间文件及其临时文件；合并失败时也删除未完成的输出临时文件
+                    self._remove_chunk_files(input_path, len(chunks))
+                return True
             else:
                 # 生成新的输出文件名
-                output_path = input_path.with_name(f"{input_path.stem}..mp4")  # 输出文件名加上 "..mp4"
+                output_path = self.output_path_for(input_path)
                 
                 logger.info(f"Starting transcoding for {input_path} to {output_path}")
-                cmd = [
-                    'ffmpeg', '-i', str(input_path),
-                    '-c:v', 'libx264', '-preset', 'medium',
-                    '-crf', '23', '-c:a', 'aac',
-                    '-strict', '2', '-b:a', '128k',
-                    '-movflags', '+faststart', '-y', str(output_path)
-                ]
-                
-                # 控制 ffmpeg 日志输出
-                if not self.ffmpeg_logging:
-                    cmd.append('-loglevel')
-                    cmd.append('quiet')
+                input_cmd = ['ffmpeg'] + self._input_args() + ['-i', str(input_path)]
+                passlogfile = input_path.with_name(f"{input_path.stem}_2pass") if two_pass else None
+                try:
+                    if passlogfile:
+                        self._first_pass(input_cmd, passlogfile)
+
+                    cmd = input_cmd + self._encode_args(passlogfile=passlogfile) + self._output_args(output_path)
+                    self._run_ffmpeg(cmd)
+                except BaseException:
+                    self._remove_temp_output(output_path)  # ffmpeg 失败时不留下写了一半的临时文件
+                    raise
+                finally:
+                    if passlogfile:
+                        self._remove_pass_logs(passlogfile)
 
-                # 输出 ffmpeg 命令到日志
-                logger.info(f"Executing command: {' '.join(cmd)}")
-                
-                # 使用 Popen 执行命令并实时输出日志
-                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                for line in process.stdout:
-                    logger.info(f"FFmpeg output: {line.strip()}")
-                stderr_output = process.stderr.read()
-                if stderr_output:
-                    logger.error(f"FFmpeg error output: {stderr_output.strip()}")
-                
-                process.wait()  # 等待进程结束
-                
                 logger.info(f"Transcoding completed for {input_path}")
-                
-                # 检查输出文件是否创建成功
-                if output_path.exists() and output_path.stat().st_size > 0:
-                    return True
-                else:
-                    logger.error(f"Output file is empty or not created: {output_path}")
-                    return False
+
+                # 检查输出文件是否创建成功，成功后改名为正式输出
+                return self._finish_output(output_path)
                 
         except subprocess.CalledProcessError as e:
             logger.error(f"Transcoding error for {input_path}: {e}")
-            logger.error(f"FFmpeg error output: {e.stderr}")  # 输出 ffmpeg 错误信息
+            if e.stderr:
+                logger.error(f"FFmpeg error output: {e.stderr}")  # 输出 ffmpeg 错误信息
             return False
         except Exception as e:
             logger.error(f"Unexpected error while transcoding {input_path}: {e}")
             return False
 
+    def transcode_batch(self, input_paths: List[Path]) -> List[bool]:
+        """用一个 ffmpeg 进程同时转码多个小文件，分摊进程启动和编解码器初始化的开销
+
+        每个输入通过 -map 对应一个输出；整批命令失败时逐个重试，避免一个损坏的文件拖累整批。
+        """
+        output_paths = [self.output_path_for(input_path) for input_path in input_paths]
+        logger.info(f"Starting batch transcoding for {len(input_paths)} files: {', '.join(p.name for p in input_paths)}")
+
+        cmd = ['ffmpeg'] + self._input_args()
+        for input_path in input_paths:
+            cmd += ['-i', str(input_path)]
+        threads = max(1, self.threads // len(input_paths))  # 同一进程内的多个编码器分摊线程
+        for index, output_path in enumerate(output_paths):
+            cmd += ['-map', f'{index}:v:0?', '-map', f'{index}:a:0?'] + self._encode_args(threads) + self._output_args(output_path)
+
+        try:
+            self._run_ffmpeg(cmd)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Batch transcoding failed ({e}), retrying files one by one")
+            # 整批失败时各输出可能都只写了一部分，重试前全部删除
+            for output_path in output_paths:
+                self._remove_temp_output(output_path)
+            return [self.transcode_video(input_path) for input_path in input_paths]
+
+        results = []
+        for input_path, output_path in zip(input_paths, output_paths):
+            # 检查输出文件是否创建成功，成功后改名为正式输出
+            success = self._finish_output(output_path)
+            if success:
+                logger.info(f"Transcoding completed for {input_path}")
+            results.append(success)
+        return results
+
+    def plan_batches(self, files: List[Path]) -> List[List[Path]]:
+        """把小文件按 batch_size 分组；需要切割的大文件、MP4/MOV 和两遍编码的文件单独处理"""
+        if self.batch_size == 1 or self.two_pass:
+            return [[f] for f in files]
+
+        batches = []
+        small_files = []
+        for f in files:
+            # 大文件需要切割，MP4/MOV 可能只需复制流，都交给 transcode_video 单独处理
+            if f.suffix.lower() in COPY_SUFFIXES or f.stat().st_size > CHUNK_SIZE_MB * 1024 * 1024:
+                batches.append([f])
+            else:
+                small_files.append(f)
+        batches += [small_files[i:i + self.batch_size] for i in range(0, len(small_files), self.batch_size)]
+        return batches
+
+    def iter_video_files(self) -> Iterator[Path]:
+        """用 os.scandir 遍历目录，按文件名过滤后才构造 Path
+
+        跳过以 ._ 开头的文件、没有主文件名的点文件（如 ".mp4"）、已转换的 "..mp4" 文件和已有转换结果的文件；
+        global 模式下递归子目录（不跟随目录符号链接）。
+        """
+        stack = [str(self.directory)]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.search_mode == 'global':
+                                stack.append(entry.path)
+                        elif (not name.startswith('._')
+                              and name.rfind('.') > 0  # 与 Path.suffix 一致：".mp4" 没有后缀
+                              and name.lower().endswith(self.supported_formats)
+                              and not name.endswith('..mp4')
+                              and entry.is_file()):
+                            # 上次运行已完成转码（输出只在成功后才改名生成），跳过以便断点续转；
+                            # 直接拼接字符串检查，与 output_path_for 的命名一致，跳过的文件不构造 Path
+                            if os.path.exists(os.path.join(current, os.path.splitext(name)[0] + '..mp4')):
+                                logger.info(f"Output already exists, skipping: {entry.path}")
+                                continue
+                            yield Path(entry.path)
+            except OSError as e:
+                logger.error(f"Error scanning directory {current}: {e}")
+
     def process_directory(self) -> None:
         """处理目录中的所有支持格式的文件并转换为 MP4"""
         if not self.directory.exists():
             logger.error(f"Input directory does not exist: {self.directory}")
             sys.exit(1)
 
-        # 获取待处理文件列表
-        files_to_process = list(self.directory.glob('*')) if self.search_mode == 'local' else list(self.directory.rglob('*'))
-
-        # 过滤掉以 ._ 开头的文件
-        files_to_process = [f for f in files_to_process if not f.name.startswith('._')]
-        
         # 只统计需要转换的文件
-        files_to_convert = [f for f in files_to_process if f.suffix.lower() in self.supported_formats and not f.name.endswith("..mp4")]
+        files_to_convert = list(self.iter_video_files())
         total_files = len(files_to_convert)
 
         if total_files == 0:
@@ -254,20 +636,49 @@ class VideoTranscoder:
         successful_conversions = 0
         failed_conversions = 0
 
-        for index, input_path in enumerate(files_to_convert, start=1):
-            logger.info(f"Processing file {index}/{total_files}: {input_path.name}")
-            
-            # 转码文件
-            if self.transcode_video(input_path):
-                successful_conversions += 1
-                # 删除原始文件
-                input_path.unlink()
-                logger.info(f"Deleted original file: {input_path}")
-            else:
-                failed_conversions += 1
-
-            # 输出整体进度
-            logger.info(f"Progress: {successful_conversions + failed_conversions}/{total_files} files processed.")
+        if self.encoder != 'x264':
+            # 硬件编码会话数是整机共享的，一个批次的 ffmpeg 进程就要占用 batch_size 个会话
+            self.batch_size = min(self.batch_size, MAX_HW_ENCODER_SESSIONS)
+        batches = self.plan_batches(files_to_convert)
+
+        # 按实际并行数分配每个 ffmpeg 的线程，使总线程数约等于 CPU 核数
+        workers = min(self.jobs, len(batches))
+        if self.encoder != 'x264':
+            # 同时转码的文件数 × 每个文件的会话数（批次的编码器数或切割区间数）不超过会话上限
+            workers = min(workers, MAX_HW_ENCODER_SESSIONS // self.batch_size)
+            self.hw_sessions = max(1, MAX_HW_ENCODER_SESSIONS // workers)
+        self.threads = max(1, (os.cpu_count() or 1) // workers)
+        logger.info(f"Transcoding {total_files} files in {len(batches)} batches "
+                    f"with {workers} workers, {self.threads} threads each")
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_transcode_batch, self.for_batch(batch), batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    results, new_probe_entries = future.result()
+                    self.probe_cache.update(new_probe_entries)
+                except Exception as e:
+                    logger.error(f"Worker failed while transcoding {', '.join(str(p) for p in batch)}: {e}")
+                    results, new_probe_entries = [False] * len(batch), {}
+
+                for input_path, success in zip(batch, results):
+                    if success:
+                        successful_conversions += 1
+                        # 删除原始文件
+                        input_path.unlink()
+                        logger.info(f"Deleted original file: {input_path}")
+                    else:
+                        failed_conversions += 1
+
+                # 有新的 ffprobe 结果时立即写回缓存，运行中断后续转时不必重新探测
+                if new_probe_entries:
+                    self.save_probe_cache()
+
+                # 输出整体进度
+                logger.info(f"Progress: {successful_conversions + failed_conversions}/{total_files} files processed.")
+
+        self.save_probe_cache()
 
         # 输出统计信息
         logger.info(f"\nConversion Summary:")
@@ -275,11 +686,21 @@ class VideoTranscoder:
         logger.info(f"Successfully converted: {successful_conversions}")
         logger.info(f"Failed conversions: {failed_conversions}")
 
+def _transcode_batch(transcoder: VideoTranscoder, input_paths: List[Path]) -> Tuple[List[bool], Dict[str, Any]]:
+    """在工作进程中转码一批文件（顶层函数，便于进程池序列化），返回每个文件是否成功
+
+    同时返回本次新增的 ffprobe 缓存条目，工作进程中的修改不会自动同步回主进程。
+    """
+    if len(input_paths) > 1:
+        return transcoder.transcode_batch(input_paths), transcoder.new_probe_entries
+    logger.info(f"Processing file: {input_paths[0].name}")
+    return [transcoder.transcode_video(input_paths[0])], transcoder.new_probe_entries
+
 def check_dependencies() -> bool:
     """检查必要的依赖是否已安装"""
     try:
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        subprocess.run(['ffprobe', '-version'], capture_output=True, check=True)
+        run_command(['ffmpeg', '-version'], capture_output=True, check=True)
+        run_command(['ffprobe', '-version'], capture_output=True, check=True)
         return True
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         logger.error(f"Dependency check failed: {e}")
@@ -292,6 +713,14 @@ def main():
     parser.add_argument('-p', '--path', type=str, default=os.path.expanduser("~/Movies/bgm"), help='输入文件夹路径')
     parser.add_argument('-s', '--search', type=str, choices=['local', 'global'], default='local', help='搜索模式')
     parser.add_argument('-f', '--ffmpeg_logging', type=str, choices=['y', 'n'], default='n', help='控制 ffmpeg 日志输出 (y: 输出, n: 不输出)')
+    parser.add_argument('-e', '--encoder', type=str, choices=['auto'] + list(VIDEO_ENCODERS), default='x264',
+                        help='H.264 编码器 (auto: 自动检测硬件编码器，默认: x264)')
+    parser.add_argument('--two_pass', type=str, choices=['y', 'n'], default='n',
+                        help='使用 libx264 两遍编码 (y: 按 --bitrate 目标码率, n: CRF 23)')
+    parser.add_argument('-b', '--bitrate', type=str, default='2M', help='两遍编码的目标视频码率 (默认: 2M)')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='每个 ffmpeg 进程同时转码的小文件数 (默认: 1，即每个文件单独转码)')
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs(), help='同时转码的文件数 (默认: CPU 核数的一半)')
     
     args = parser.parse_args()
 
@@ -306,12 +735,32 @@ def main():
         logger.error("请运行: ./install.sh 来安装依赖")
         sys.exit(1)
 
+    # 确定视频编码器
+    available = available_encoders()
+    if args.encoder == 'auto':
+        encoder = detect_encoder(available)
+        if encoder is None:
+            logger.error("没有可用的 H.264 编码器")
+            sys.exit(1)
+    else:
+        encoder = args.encoder
+        # 列表中存在只说明 ffmpeg 编译了该编码器，还需试编码确认设备和驱动可用
+        if encoder not in available or not encoder_works(encoder):
+            logger.error(f"当前 ffmpeg 不支持编码器: {VIDEO_ENCODERS[encoder]['name']}")
+            sys.exit(1)
+    logger.info(f"Using video encoder: {VIDEO_ENCODERS[encoder]['name']}")
+    two_pass = args.two_pass == 'y'
+    if two_pass and encoder != 'x264':
+        logger.error("两遍编码仅支持 x264 编码器")
+        sys.exit(1)
+
     # 开始计时
     start_time = time.time()
 
     # 创建 VideoTranscoder 实例并处理目录
     ffmpeg_logging = args.ffmpeg_logging == 'y'  # 将 'y' 转换为布尔值
-    transcoder = VideoTranscoder(args.path, args.search, load_supported_formats(CONFIG_FILE), ffmpeg_logging)
+    transcoder = VideoTranscoder(args.path, args.search, SUPPORTED_SUFFIXES, ffmpeg_logging,
+                                 args.jobs, encoder, two_pass, args.bitrate, args.batch)
     transcoder.process_directory()
 
     # 结束计时